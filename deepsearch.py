@@ -1,13 +1,29 @@
 import asyncio
 import argparse
 import aiohttp
-import json
+import hashlib
 import logging
+import math
+import orjson
 import os
 import re
+import sqlite3
+import threading
 from duckduckgo_search import DDGS
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
 from html2text import HTML2Text
-from time import sleep
+from pathlib import Path
+from selectolax.lexbor import LexborHTMLParser
+from time import sleep, time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# uvloop is optional (it is not available on Windows), asyncio's own loop is used without it
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 logger = logging.getLogger('server_logger')
 logger.setLevel(logging.INFO)
@@ -22,49 +38,572 @@ logger.addHandler(fileHandler)
 
 # Local LLM server settings
 IP="192.168.0.143"
-LLAMA_CPP_URL = f"http://{IP}:8080/v1/chat/completions"
-JSON_REGEX =  r"\{.*\}"
+# Default sampling temperature, overridden by the "temperature" config entry
+LLM_TEMPERATURE = 0.7
+LLAMA_CPP_BASE_URL = f"http://{IP}:8080"
+LLAMA_CPP_URL = f"{LLAMA_CPP_BASE_URL}/v1/chat/completions"
+LLAMA_CPP_TOKENIZE_URL = f"{LLAMA_CPP_BASE_URL}/tokenize"
+LLAMA_CPP_DETOKENIZE_URL = f"{LLAMA_CPP_BASE_URL}/detokenize"
+LLAMA_CPP_MODELS_URL = f"{LLAMA_CPP_BASE_URL}/v1/models"
+
+# Request bodies of at least LLM_COMPRESS_MIN_BYTES are sent gzipped; 0 disables it.
+# The server must be able to decode them (llama.cpp needs to be built with zlib).
+LLM_COMPRESS_MIN_BYTES = int(os.getenv("LLM_COMPRESS_MIN_BYTES", "0"))
+
+# Page text sent to the LLM is cut to MAX_PAGE_TOKENS tokens of the served model,
+# the aggregated contexts are trimmed to the most relevant ones within CONTEXT_TOKEN_BUDGET tokens
+MAX_PAGE_TOKENS = 4000
+CONTEXT_TOKEN_BUDGET = 32000
+
+# With the "batch_extract" config entry, several pages share one LLM call of up to
+# BATCH_EXTRACT_TOKENS page tokens and at most BATCH_EXTRACT_PAGES pages
+BATCH_EXTRACT_TOKENS = 12000
+BATCH_EXTRACT_PAGES = 8
+
+# Web page download settings: bodies are cut at MAX_PAGE_BYTES, non-HTML content is skipped
+MAX_PAGE_BYTES = int(os.getenv("MAX_PAGE_BYTES", str(512 * 1024)))
+PAGE_CHUNK_BYTES = 64 * 1024
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+
+# Query parameters that only track the visitor and never change the page content
+TRACKING_PARAM_PREFIXES = ("utm_", "fbclid", "gclid")
+
+# Links that are never fetched: non-HTML downloads and sites that serve little text without JavaScript
+SKIPPED_LINK_SUFFIXES = (
+    ".pdf", ".zip", ".gz", ".tar", ".rar", ".7z", ".exe", ".dmg", ".iso",
+    ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx",
+    ".jpg", ".jpeg", ".png", ".gif", ".svg", ".mp3", ".mp4", ".avi", ".mov"
+)
+BLOCKED_HOSTS = ("youtube.com", "youtu.be", "facebook.com", "instagram.com", "tiktok.com")
+
+# Pages with less text than this are cookie walls, error pages or empty shells, and never reach the LLM
+MIN_TEXT_CHARS = 500
+
+# Digests of the page texts processed so far; pages with the same text are treated as duplicates
+content_digests = set()
+
+# Search queries and contexts at least this similar to an earlier one are treated as paraphrases
+QUERY_SIMILARITY_THRESHOLD = 0.9
+CONTEXT_SIMILARITY_THRESHOLD = 0.9
+STOP_WORDS = frozenset([
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in", "is", "it",
+    "of", "on", "or", "the", "to", "vs", "what", "when", "where", "which", "who", "why", "with"
+])
+
+# Brace-matching scans tried by extract_json, so stray braces can't make the search quadratic
+MAX_JSON_CANDIDATES = 16
+
+# Tags whose contents are never part of the readable page text
+NON_TEXT_TAGS = ["script", "style", "noscript", "template", "svg"]
+
+# HTTP client settings: web fetches must be quick so one dead site can't hold a worker,
+# LLM calls may generate for a long time and are never timed out
+SESSION_TIMEOUT = aiohttp.ClientTimeout(total=60, sock_connect=10)
+LLM_TIMEOUT = aiohttp.ClientTimeout(total=None)
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=3)
+SESSION_HEADERS = {"User-Agent": "OpenDeepResearcher/1.0"}
+
+# LLM response cache, enabled with the "llm_cache" config entry; only deterministic
+# ("temperature": 0) replies are cached, sampled replies would freeze a single sample
+LLM_CACHE_PATH = os.getenv("LLAMACPP_CACHE_PATH", ".llm_cache.sqlite")
+LLM_CACHE_TTL = 24 * 60 * 60 # secs
+
+# DuckDuckGo search results cache, disabled with DDG_CACHE=0
+DDG_CACHE_ENABLED = os.getenv("DDG_CACHE", "1") == "1"
+DDG_CACHE_PATH = os.getenv("DDG_CACHE_PATH", ".ddg_cache.sqlite")
+DDG_CACHE_TTL = 60 * 60 # secs
+
+# Concurrency budgets: LLM requests should match the server's parallel slots (-np),
+# web fetches and HTML parsing are bounded separately so they don't compete with LLM calls
+LLM_CONCURRENCY = 2
+FETCH_CONCURRENCY = 32
+PARSE_CONCURRENCY = os.cpu_count() or 4
+
+# The planner for the next iteration starts once this fraction of the links has been processed
+PLANNER_START_FRACTION = 0.6
+# Only this many of the most recent search queries are shown to the planner
+PLANNER_QUERY_HISTORY = 32
+
+# Per-link time limits of the fetch and LLM pipeline stages, so one slow page can't hold a worker
+LINK_FETCH_TIMEOUT = 30 # secs
+LINK_LLM_TIMEOUT = 300 # secs
+
+# ===========
+# LLM Prompts
+# ===========
+
+# System messages and instructions are static and come before any variable content
+# (user query, pages, contexts), so llama.cpp can reuse the KV cache of the shared prefix.
+
+SYS_QUERIES = (
+    "You are an expert research assistant. Given the user's query, generate up to {n_queries} distinct, "
+    "precise search queries that would help gather comprehensive information on the topic. "
+    "Return a JSON object that contains a list of queries precisely in the following format: "
+    '{{"queries" : ["query1", "query2", "query3"]}}'
+)
+
+SYS_JUDGE_EXTRACT = "You are a strict evaluator of research relevance and an expert in extracting relevant information."
+INSTRUCTION_JUDGE_EXTRACT = (
+    "You are a critical research evaluator and information extractor. Given the user's query, the search query "
+    "that led to the page below, and the webpage content, determine if the webpage contains information relevant "
+    "and useful for addressing the query and, if it does, extract all pieces of information that are relevant "
+    "to answering the user's query. Respond with a valid JSON precisely in the following format: "
+    '{"useful" : "<yes-no>", "relevant" : "<text>"}'
+    ', substitute <yes-no> with word: "Yes" if the page is useful, or "No" if it is not; '
+    "substitute <text> with a plain text containing the extracted information without commentaries, "
+    "or with an empty string if the page is not useful."
+)
+
+INSTRUCTION_JUDGE_EXTRACT_BATCH = (
+    "You are a critical research evaluator and information extractor. Given the user's query and the numbered "
+    "webpages below, each with the search query that led to it, determine for each webpage if it contains "
+    "information relevant and useful for addressing the query and, if it does, extract all pieces of information "
+    "that are relevant to answering the user's query. Respond with a valid JSON precisely in the following format: "
+    '{"results" : [{"id" : 0, "useful" : "<yes-no>", "relevant" : "<text>"}, '
+    '{"id" : 1, "useful" : "<yes-no>", "relevant" : "<text>"}]}'
+    ', with one entry per webpage; substitute <yes-no> with word: "Yes" if the page is useful, or "No" if it is not; '
+    "substitute <text> with a plain text containing the information extracted from that webpage without "
+    "commentaries, or with an empty string if the page is not useful."
+)
+
+SYS_PLAN = "You are a systematic research planner."
+INSTRUCTION_PLAN = (
+    "You are an analytical research assistant. Based on the original query, the search queries performed so far, "
+    "and the extracted contexts from webpages below, determine if further research is needed. "
+    "If further research is needed, set done to false and provide up to {n_queries} new search queries. "
+    "If no further research is needed, set done to true and provide an empty list. "
+    "Return a JSON object precisely in the following format: "
+    '{{"done" : false, "queries" : ["query1", "query2", "query3"]}}'
+)
+
+SYS_REPORT = "You are a skilled report writer."
+INSTRUCTION_REPORT = (
+    "You are an expert researcher and report writer. Based on the gathered contexts below and the original query, "
+    "write a comprehensive, well-structured, and detailed report that addresses the query thoroughly. "
+    "Include all relevant insights and conclusions without extraneous commentary."
+)
+
+@lru_cache(maxsize=32)
+def render_prompt(template, n_queries):
+    """
+    Fill 'n_queries' into a prompt template; every distinct prompt is rendered only once per run.
+    """
+    return template.format(n_queries=n_queries)
+
+# JSON schemas of the structured replies; llama.cpp turns them into a grammar,
+# so the model can only produce replies that parse.
+
+def json_schema_format(name, schema):
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+JUDGE_EXTRACT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "useful": {"type": "string", "enum": ["Yes", "No"]},
+        "relevant": {"type": "string"}
+    },
+    "required": ["useful", "relevant"],
+    "additionalProperties": False
+}
+JUDGE_EXTRACT_FORMAT = json_schema_format("judge_extract", JUDGE_EXTRACT_SCHEMA)
+
+JUDGE_EXTRACT_BATCH_FORMAT = json_schema_format("judge_extract_batch", {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"}, **JUDGE_EXTRACT_SCHEMA["properties"]},
+                "required": ["id", "useful", "relevant"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["results"],
+    "additionalProperties": False
+})
+
+QUERIES_FORMAT = json_schema_format("queries", {
+    "type": "object",
+    "properties": {
+        "queries": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["queries"],
+    "additionalProperties": False
+})
+
+PLAN_FORMAT = json_schema_format("plan", {
+    "type": "object",
+    "properties": {
+        "done": {"type": "boolean"},
+        "queries": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["done", "queries"],
+    "additionalProperties": False
+})
+
+# ============================
+# Response Cache
+# ============================
+
+class ResponseCache:
+    """
+    A tiny SQLite-backed key/value store with per-entry expiration.
+    Values are stored as JSON, so anything orjson.dumps() accepts can be cached.
+    """
+
+    def __init__(self, path, table="cache"):
+        self.table = table
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+            )
+            # Expired entries are never read again, evict them so the file doesn't grow without bound
+            self.conn.execute(f"DELETE FROM {table} WHERE expires < ?", (time(),))
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT value, expires FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires < time():
+            return None
+        return orjson.loads(value)
+
+    def set(self, key, value, expire):
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires) VALUES (?, ?, ?)",
+                (key, orjson.dumps(value), time() + expire)
+            )
+
+class LLMCache:
+    """
+    Cache of llama.cpp replies of one served model, keyed by a SHA-256 of the server URL,
+    the model and the whole request payload (temperature, response format, ...).
+    Message contents are whitespace-normalized before hashing, so prompts
+    differing only in formatting share an entry. Counts hits and misses.
+    Lookups hit SQLite, so call get() and set() from a worker thread.
+    """
+
+    def __init__(self, path, ttl, model):
+        self.store = ResponseCache(path)
+        self.ttl = ttl
+        self.model = model
+        self.stats = {"hits": 0, "misses": 0}
+        self.stats_lock = threading.Lock()
+
+    def key(self, payload):
+        normalized = [
+            {"role": message["role"], "content": re.sub(r"\s+", " ", message["content"]).strip()}
+            for message in payload["messages"]
+        ]
+        key_source = orjson.dumps(
+            {**payload, "url": LLAMA_CPP_URL, "model": self.model, "messages": normalized},
+            option=orjson.OPT_SORT_KEYS
+        )
+        return hashlib.sha256(key_source).hexdigest()
+
+    def get(self, key):
+        content = self.store.get(key)
+        with self.stats_lock:
+            self.stats["hits" if content is not None else "misses"] += 1
+        return content
+
+    def set(self, key, content):
+        self.store.set(key, content, self.ttl)
 
 # ============================
 # Asynchronous Helper Functions
 # ============================
 
+def find_json_object(text, start):
+    """
+    Return the end index (exclusive) of the balanced JSON object that starts at 'start',
+    or -1 if the braces are never closed. Braces inside string literals are ignored.
+    """
+    depth = 0
+    in_string = False
+    escaped = False
+    for idx in range(start, len(text)):
+        char = text[idx]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return idx + 1
+    return -1
+
 def extract_json(response):
-    if json_match := re.search(JSON_REGEX, response, re.DOTALL):
-        json_str = json_match.group()
-        return json.loads(json_str)
+    """
+    Parse the first valid JSON object embedded in the response, skipping unclosed braces
+    and brace pairs that are not valid JSON (e.g. in a reasoning section before the answer).
+    """
+    start = response.find("{")
+    for _ in range(MAX_JSON_CANDIDATES):
+        if start == -1:
+            break
+        end = find_json_object(response, start)
+        if end == -1:
+            start = response.find("{", start + 1)
+            continue
+        try:
+            return orjson.loads(response[start:end])
+        except orjson.JSONDecodeError:
+            start = response.find("{", end)
     raise Exception(f"No JSON object was found in {response}")
 
-async def call_llamacpp_async(session, messages):
+def normalize_query(query):
+    """
+    Normalize a search query for caching: lower-case it and collapse whitespace.
+    """
+    return " ".join(query.lower().split())
+
+def canonicalize_url(url):
+    """
+    Normalize a URL for deduplication: lower-case the scheme and host, drop tracking
+    query parameters, the fragment and a trailing slash.
+    """
+    parts = urlsplit(url)
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith(TRACKING_PARAM_PREFIXES)
+    ]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), urlencode(query), ""))
+
+def is_link_supported(canonical_link):
+    """
+    Check that a canonical link is an HTTP(S) page that can be turned into useful text.
+    """
+    parts = urlsplit(canonical_link)
+    if parts.scheme not in ("http", "https"):
+        return False
+    if parts.path.lower().endswith(SKIPPED_LINK_SUFFIXES):
+        return False
+    host = parts.hostname or ""
+    return not any(host == blocked or host.endswith("." + blocked) for blocked in BLOCKED_HOSTS)
+
+def page_digest(page_text):
+    """
+    Hash the whitespace-normalized page text to detect mirrored pages.
+    The whole text is hashed: pages of one site often share kilobytes of menus at the start.
+    """
+    normalized = " ".join(page_text.split())
+    return hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+
+def term_vector(text):
+    """
+    Represent the text as an L2-normalized bag of lower-cased words, ignoring stop words.
+    Possessive and plural suffixes are stripped, so "panel's" and "panels" both count as "panel".
+    """
+    words = (word.removesuffix("'s") for word in re.findall(r"[\w']+", text.lower()))
+    words = (word[:-1] if len(word) > 3 and word.endswith("s") else word for word in words)
+    counts = Counter(word for word in words if word not in STOP_WORDS)
+    norm = math.sqrt(sum(count * count for count in counts.values()))
+    return {word: count / norm for word, count in counts.items()} if norm else {}
+
+def cosine_similarity(vector_a, vector_b):
+    """
+    Cosine similarity of two normalized term vectors.
+    """
+    if len(vector_a) > len(vector_b):
+        vector_a, vector_b = vector_b, vector_a
+    return sum(weight * vector_b.get(word, 0.0) for word, weight in vector_a.items())
+
+def drop_similar_texts(texts, known_vectors, threshold):
+    """
+    Return the texts that are less than 'threshold' similar to every known text and to each other;
+    anything that is not a string is dropped.
+    The vectors of the returned texts are appended to 'known_vectors'.
+    """
+    distinct_texts = []
+    for text in texts:
+        if not isinstance(text, str):
+            continue
+        vector = term_vector(text)
+        if any(cosine_similarity(vector, known) >= threshold for known in known_vectors):
+            logger.info("Dropping near-duplicate: %s", text[:200])
+            continue
+        known_vectors.append(vector)
+        distinct_texts.append(text)
+    return distinct_texts
+
+def drop_seen_queries(queries, seen_queries):
+    """
+    Return the queries whose normalized form is not in 'seen_queries' and add them to it;
+    anything that is not a string is dropped.
+    """
+    new_queries = []
+    for query in queries:
+        if not isinstance(query, str):
+            continue
+        key = normalize_query(query)
+        if not key or key in seen_queries:
+            continue
+        seen_queries.add(key)
+        new_queries.append(query)
+    return new_queries
+
+def trim_contexts(contexts, token_budget):
+    """
+    Sort (relevance, n_tokens, context) entries by decreasing relevance in place,
+    and drop the least relevant ones until the total token count fits into the budget.
+    """
+    contexts.sort(key=lambda entry: -entry[0])
+    n_tokens = sum(entry[1] for entry in contexts)
+    while n_tokens > token_budget and contexts:
+        _, dropped_tokens, dropped = contexts.pop()
+        n_tokens -= dropped_tokens
+        logger.info("Dropping the least relevant context (%s tokens): %s", dropped_tokens, dropped[:200])
+
+def html_to_text(page):
+    """
+    Convert raw HTML into plain text with the lexbor parser.
+    Falls back to the slower html2text converter if lexbor fails.
+    """
+    try:
+        tree = LexborHTMLParser(page)
+        tree.strip_tags(NON_TEXT_TAGS)
+        return tree.body.text(separator=" ", strip=True) if tree.body else ""
+    except Exception as e:
+        logger.info("Error parsing page with lexbor, falling back to html2text: %s", e)
+        return HTML2Text().handle(page)
+
+async def call_llamacpp_async(run, messages, response_format=None):
     """
-    Asynchronously call the local llama.cpp server with the provided messages.
+    Asynchronously call the local llama.cpp server with the provided messages,
+    using the temperature, LLM concurrency limit and reply cache of the RunState 'run'.
+    An optional 'response_format' constrains the reply, e.g. {"type": "json_object"} or a JSON schema.
     Returns the content of the assistant’s reply.
     """
     headers = {"Content-Type": "application/json"}
     payload = {
         "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": -1
+        "temperature": run.cfg.temperature,
+        "max_tokens": -1,
+        "cache_prompt": True
     }
+    if response_format:
+        payload["response_format"] = response_format
+
+    llm_cache = run.llm_cache
+    cache_key = None
+    if llm_cache:
+        cache_key = llm_cache.key(payload)
+        if (content := await asyncio.to_thread(llm_cache.get, cache_key)) is not None:
+            logger.info("LLM cache hit: %s", cache_key)
+            return content
+
+    body = orjson.dumps(payload)
+    compress = "gzip" if LLM_COMPRESS_MIN_BYTES and len(body) >= LLM_COMPRESS_MIN_BYTES else None
 
     try:
-        async with session.post(LLAMA_CPP_URL, timeout=0, headers=headers, json=payload) as resp:
+        async with run.llm_semaphore, run.session.post(
+            LLAMA_CPP_URL, timeout=LLM_TIMEOUT, headers=headers, data=body, compress=compress
+        ) as resp:
             if resp.status == 200:
-                result = await resp.json()
+                result = orjson.loads(await resp.read())
                 try:
-                    return result['choices'][0]['message']['content']
+                    content = result['choices'][0]['message']['content']
+                    if cache_key:
+                        await asyncio.to_thread(llm_cache.set, cache_key, content)
+                    return content
                 except (KeyError, IndexError):
                     logger.info("Unexpected llama.cpp response structure: %s", result)
                     return None
             else:
-                text = await resp.text()
+                text = await resp.text(encoding="utf-8", errors="replace")
                 logger.info("llama.cpp API error: %s - %s", resp.status, text)
                 return None
     except Exception as e:
         logger.info("Error calling llama.cpp: %s", e)
         return None
 
-async def generate_search_queries_async(session, user_query, n_queries = 4):
+async def get_model_id_async(session):
+    """
+    Return the id of the model served by llama.cpp, or an empty string if the server doesn't tell.
+    """
+    try:
+        async with session.get(LLAMA_CPP_MODELS_URL) as resp:
+            resp.raise_for_status()
+            return orjson.loads(await resp.read())["data"][0]["id"]
+    except Exception as e:
+        logger.info("Error getting the served model: %s", e)
+        return ""
+
+async def tokenize_async(session, text):
+    """
+    Tokenize the text with the model served by llama.cpp. Returns the list of token ids.
+    """
+    payload = {"content": text, "add_special": False}
+    async with session.post(LLAMA_CPP_TOKENIZE_URL, data=orjson.dumps(payload),
+                            headers={"Content-Type": "application/json"}) as resp:
+        resp.raise_for_status()
+        return orjson.loads(await resp.read())["tokens"]
+
+async def detokenize_async(session, tokens):
+    """
+    Convert token ids back into text with the model served by llama.cpp.
+    """
+    payload = {"tokens": tokens}
+    async with session.post(LLAMA_CPP_DETOKENIZE_URL, data=orjson.dumps(payload),
+                            headers={"Content-Type": "application/json"}) as resp:
+        resp.raise_for_status()
+        return orjson.loads(await resp.read())["content"]
+
+async def count_tokens_async(session, text):
+    """
+    Count the tokens of the text for the served model.
+    If the tokenizer is unavailable, 4 characters per token are assumed.
+    """
+    try:
+        return len(await tokenize_async(session, text))
+    except Exception as e:
+        logger.info("Error tokenizing text, estimating its token count: %s", e)
+        return len(text) // 4 + 1
+
+async def truncate_to_tokens_async(session, text, max_tokens):
+    """
+    Cut the text to at most 'max_tokens' tokens of the served model.
+    Returns the text and its token count; the count is an upper bound when the text was
+    short enough to skip the tokenizer. If the tokenizer is unavailable, the text is cut
+    at 4 characters per token.
+    """
+
+    # A token covers at least one byte, so short texts never need the tokenizer
+    if (n_bytes := len(text.encode())) <= max_tokens:
+        return text, n_bytes
+
+    # Tokens are rarely longer than a few characters, so text past 16 characters per token
+    # can never make it into the result and isn't sent to the tokenizer
+    text = text[:max_tokens * 16]
+    try:
+        tokens = await tokenize_async(session, text)
+        if len(tokens) <= max_tokens:
+            return text, len(tokens)
+        logger.info("Truncating text from %s to %s tokens", len(tokens), max_tokens)
+        return await detokenize_async(session, tokens[:max_tokens]), max_tokens
+    except Exception as e:
+        logger.info("Error tokenizing text, truncating by characters: %s", e)
+        return text[:max_tokens * 4], max_tokens
+
+async def generate_search_queries_async(run, user_query, n_queries = 4):
     """
     Ask the LLM to produce up to 'n_queries' precise search queries (in Python list format)
     based on the user’s query.
@@ -73,18 +612,12 @@ async def generate_search_queries_async(session, user_query, n_queries = 4):
     logger.info("generate_search_queries_async")
 
     json_key = "queries"
-    prompt = (
-        f"You are an expert research assistant. Given the user's query, generate up to {n_queries} distinct, "
-        "precise search queries that would help gather comprehensive information on the topic. "
-        "Return a JSON object that contains a list of queries precisely in the following format: "
-        f'{{"{json_key}" : ["query1", "query2", "query3"]}}'
-    )
     messages = [
-        {"role": "system", "content": f"{prompt}"},# "You are a helpful and precise research assistant."},
-        {"role": "user", "content": f"User Query: {user_query}"} #\n\n{prompt}"}
+        {"role": "system", "content": render_prompt(SYS_QUERIES, n_queries)},
+        {"role": "user", "content": f"User Query: {user_query}"}
     ]
 
-    response = await call_llamacpp_async(session, messages)
+    response = await call_llamacpp_async(run, messages, response_format=QUERIES_FORMAT)
     logger.info("response: %s", response)
 
     search_queries = []
@@ -99,38 +632,65 @@ async def generate_search_queries_async(session, user_query, n_queries = 4):
 
     return search_queries
 
-def perform_ddg_search(query, max_links_per_query=5, max_retries=5):
+# One DDGS client per worker thread: searches run concurrently in threads, and a client
+# keeps its HTTP connections and cookies between the searches of its thread
+ddgs_clients = threading.local()
+
+def get_ddgs_client():
+    """
+    Return the DDGS client of the current thread, creating it on first use.
+    """
+    if (client := getattr(ddgs_clients, "client", None)) is None:
+        client = ddgs_clients.client = DDGS()
+    return client
+
+def perform_ddg_search(query, max_links_per_query=5, max_retries=5, cache=None):
     """
     Asynchronously perform a DuckDuckGo search for the given query.
+    Results are looked up in and stored to the optional ResponseCache 'cache'.
     Returns a list of result URLs.
     """
 
     logger.info("perform_ddg_search for: '%s'", query)
 
+    cache_key = f"{max_links_per_query}:{normalize_query(query)}"
+    if cache and (results := cache.get(cache_key)) is not None:
+        logger.info("DuckDuckGo cache hit for: '%s'", query)
+        return results
+
     max_retries = max(1, max_retries)
     base_delay = 2 # secs
     results = []
     for retry in range(max_retries):
-        delay = base_delay * (2 ** retry)  # Exponential backoff
-        sleep(delay)
+        if retry:
+            delay = base_delay * (2 ** (retry - 1))  # Exponential backoff
+            sleep(delay)
         try:
-            with DDGS() as ddgs:
-                for result in ddgs.text(query, max_results=max_links_per_query):
-                    logger.info("Search result for the query='%s':\n%s", query, result)
-                    results.append(result['href'])
+            for result in get_ddgs_client().text(query, max_results=max_links_per_query):
+                logger.info("Search result for the query='%s':\n%s", query, result)
+                results.append(result['href'])
             break
         except Exception as e:
+            # Retry on a fresh client, the failed one may hold rate-limited cookies
+            ddgs_clients.client = None
+            results = []
             if 'Ratelimit' in str(e) and retry < max_retries:
                 logger.info("Retry search due to: %s", e)
                 continue
 
             logger.info("Error performing search: %s", e)
 
+    # Empty results are usually caused by rate limiting, don't let them stick
+    if cache and results:
+        cache.set(cache_key, results, DDG_CACHE_TTL)
+
     return results
 
-async def fetch_webpage_text_async(session, url):
+async def fetch_webpage_text_async(run, url):
     """
-    Asynchronously retrieve the text content of a webpage using direct HTTP GET.
+    Asynchronously retrieve the text content of a webpage using direct HTTP GET,
+    within the fetch concurrency limit of the RunState 'run'.
+    Only HTML pages are downloaded, and at most MAX_PAGE_BYTES of the body are read.
     """
 
     logger.info("fetch_webpage_text_async")
@@ -140,170 +700,356 @@ async def fetch_webpage_text_async(session, url):
     }
 
     try:
-        async with session.get(url, headers=headers, timeout=20) as resp:
-            if resp.status == 200:
-                return await resp.text()
-            logger.info("Failed to fetch %s: %s", url, resp.status)
-            return ""
+        async with run.fetch_semaphore, run.session.get(url, headers=headers, timeout=FETCH_TIMEOUT) as resp:
+            if resp.status != 200:
+                logger.info("Failed to fetch %s: %s", url, resp.status)
+                return ""
+
+            # Pages without a Content-Type header are assumed to be HTML
+            if "Content-Type" in resp.headers and resp.content_type not in HTML_CONTENT_TYPES:
+                logger.info("Skipping %s: unsupported content type '%s'", url, resp.content_type)
+                return ""
+
+            chunks = []
+            size = 0
+            async for chunk in resp.content.iter_chunked(PAGE_CHUNK_BYTES):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= MAX_PAGE_BYTES:
+                    logger.info("Truncating %s at %s bytes", url, size)
+                    break
+
+            body = b"".join(chunks)
+
+        # Never fall back to charset detection: the LLM tolerates the odd mis-decoded character
+        try:
+            return body.decode(resp.charset or "utf-8", errors="replace")
+        except LookupError:
+            logger.info("Unknown charset '%s' for %s, decoding as UTF-8", resp.charset, url)
+            return body.decode("utf-8", errors="replace")
     except Exception as e:
         logger.info("Error fetching %s: %s", url, e)
         return ""
 
-async def is_page_useful_async(session, user_query, page_text):
+def parse_usefulness(usefulness):
     """
-    Ask the LLM if the provided webpage content is useful for answering the user's query.
-    The LLM must reply with exactly "Yes" or "No".
+    Map the LLM usefulness verdict to exactly "Yes" or "No".
+    """
+    if usefulness in ["Yes", "No"]:
+        return usefulness
+    if isinstance(usefulness, str) and "Yes" in usefulness:
+        return "Yes"
+    return "No"
+
+async def judge_and_extract_async(run, user_query, search_query, page_text):
+    """
+    Given the original query, the search query used, and the page content, have the LLM
+    decide in a single call if the page is useful and, if so, extract all information
+    relevant for answering the query. The page text is expected to be cut to the page token limit.
+    Returns the extracted context or an empty string.
     """
 
-    logger.info("is_page_useful_async")
+    logger.info("judge_and_extract_async")
 
-    json_key = "useful"
-    prompt = (
-        "You are a critical research evaluator. Given the user's query and the content of a webpage, "
-        "determine if the webpage contains information relevant and useful for addressing the query. "
-        "Respond with a valid JSON precisely in the following format: "
-        f'{{"{json_key}" : "<>"}}'
-        'substitute <> with word: "Yes" if the page is useful, or "No" if it is not.'
-    )
     messages = [
-        {"role": "system", "content": "You are a strict and concise evaluator of research relevance."},
-        {"role": "user", "content": f"User Query: {user_query}\n\nWebpage Content:\n{page_text}\n\n{prompt}"}
+        {"role": "system", "content": SYS_JUDGE_EXTRACT},
+        {"role": "user", "content": f"{INSTRUCTION_JUDGE_EXTRACT}\n\n"
+         f"User Query: {user_query}\n"
+         f"Search Query: {search_query}\n"
+         f"\nWebpage Content:"
+         f"\n{page_text}"
+        }
     ]
 
-    response = await call_llamacpp_async(session, messages)
+    response = await call_llamacpp_async(run, messages, response_format=JUDGE_EXTRACT_FORMAT)
     logger.info("response: %s", response)
-    usefulness = None
+    relevant_ctx = None
     if response:
         try:
-            usefulness = extract_json(response).get(json_key, None)
-            if not usefulness:
-                raise Exception(f"Could not dermine if the following content is useful:\n{page_text}\n")
-
+            result = extract_json(response)
+            usefulness = parse_usefulness(result.get("useful", None))
             logger.info("The information can be considered: %s", usefulness)
-            if usefulness in ["Yes", "No"]:
-                return usefulness
-            else:
-                if "Yes" in usefulness:
-                    return "Yes"
-                elif "No" in usefulness:
-                    return "No"
+            if usefulness == "No":
+                return ""
+
+            relevant_ctx = result.get("relevant", None)
+            if not relevant_ctx:
+                raise Exception(f"Could not extract relevant information from: {page_text}.", )
+
+            logger.info("Extracted relevant information: %s", relevant_ctx)
         except Exception as e:
-            logger.info("Error deciding on the information usefulness: %s", e)
+            logger.info("Error judging and extracting relevant information: %s", e)
 
-    return "No"
+    return relevant_ctx if relevant_ctx else ""
 
-async def extract_relevant_context_async(session, user_query, search_query, page_text):
+async def judge_and_extract_batch_async(run, user_query, pages):
     """
-    Given the original query, the search query used, and the page content,
-    have the LLM extract all information relevant for answering the query.
+    Judge and extract several (search query, page text) pairs in a single LLM call.
+    The page texts are expected to be cut to the page token limit.
+    Returns the extracted context or an empty string per page, in the order of 'pages'.
     """
 
-    logger.info("extract_relevant_context_async")
+    logger.info("judge_and_extract_batch_async")
 
-    json_key = "relevant"
-    prompt = (
-        "You are an expert information extractor. Given the user's query, the search query that led to this page, "
-        "and the webpage content, extract all pieces of information that are relevant to answering the user's query. "
-        "Return only the relevant context as a valid JSON precisely in the following format: "
-        f'{{"{json_key}" : "<>"}}'
-        ", substitute <> with a plain text containing the extarcted information without commentaries."
+    webpages = "\n\n".join(
+        f"Webpage {idx} (Search Query: {search_query}):\n{page_text}"
+        for idx, (search_query, page_text) in enumerate(pages)
     )
     messages = [
-        {"role": "system", "content": "You are an expert in extracting and summarizing relevant information."},
-        {"role": "user", "content": f"User Query: {user_query}\n"
-         f"Search Query: {search_query}\n"
-         f"\nWebpage Content:"
-         f"\n{page_text}\n"
-         f"\n{prompt}"
-        }
+        {"role": "system", "content": SYS_JUDGE_EXTRACT},
+        {"role": "user", "content": f"{INSTRUCTION_JUDGE_EXTRACT_BATCH}\n\nUser Query: {user_query}\n\n{webpages}"}
     ]
 
-    response = await call_llamacpp_async(session, messages)
+    response = await call_llamacpp_async(run, messages, response_format=JUDGE_EXTRACT_BATCH_FORMAT)
     logger.info("response: %s", response)
-    relevant_ctx = None
+    contexts = [""] * len(pages)
     if response:
         try:
-            relevant_ctx = extract_json(response).get(json_key, None)
-            if not relevant_ctx:
-                raise Exception(f"Could not extract relevant information from: {page_text}.", )
-
-            logger.info("Extracted relevant information: %s", relevant_ctx)
+            results = extract_json(response).get("results", None)
+            if not isinstance(results, list):
+                raise Exception(f"Could not parse a result list from the response.")
+
+            for result in results:
+                idx = result.get("id") if isinstance(result, dict) else None
+                if not isinstance(idx, int) or not 0 <= idx < len(contexts):
+                    continue
+                usefulness = parse_usefulness(result.get("useful", None))
+                relevant_ctx = result.get("relevant", None)
+                if usefulness == "Yes" and isinstance(relevant_ctx, str):
+                    contexts[idx] = relevant_ctx
+            logger.info("Extracted relevant information: %s", contexts)
         except Exception as e:
-            logger.info("Error extracting relevant information: %s", e)
+            logger.info("Error judging and extracting relevant information: %s", e)
 
-    return relevant_ctx if relevant_ctx else ""
+    return contexts
 
-async def process_link(session, link, user_query, search_query):
+async def page_to_text_async(link, page, min_text_chars=MIN_TEXT_CHARS):
     """
-    Process a single link: fetch its content, judge its usefulness, and extract context if useful.
+    Convert a fetched page to plain text in a worker thread.
+    Returns None if the conversion fails, the text is too short,
+    or the page duplicates an already processed page.
     """
 
-    logger.info("process_link")
-
-    logger.info("Fetching content from: %s", link)
-    page = await fetch_webpage_text_async(session, link)
-    if not page:
-        return None
+    logger.info("page_to_text_async")
 
     try:
-        page_text = HTML2Text().handle(page)
+        page_text = await asyncio.to_thread(html_to_text, page)
         logger.info("Raw page %s size: %s, its text size: %s", link, len(page), len(page_text))
     except Exception as e:
         logger.info("Error converting page to text: %s", e)
         return None
 
-    logger.info("Estimating page usefulness %s", link)
-    useful = await is_page_useful_async(session, user_query, page_text)
-    logger.info("Page usefulness for %s: %s", link, useful)
+    text_size = len(page_text.strip())
+    if text_size < min_text_chars:
+        logger.info("Skipping %s: text too short (%s)", link, text_size)
+        return None
+
+    digest = page_digest(page_text)
+    if digest in content_digests:
+        logger.info("Skipping %s: its content duplicates an already processed page", link)
+        return None
+    content_digests.add(digest)
+
+    return page_text
+
+async def stage_worker(handler, in_queue, out_queue, done_queue, timeout=None):
+    """
+    Pipeline worker: take argument tuples from 'in_queue' until a None sentinel arrives,
+    and pass every non-None result of 'handler' on to 'out_queue'.
+    Items for which 'handler' returns None, fails or takes longer than 'timeout' seconds
+    are dropped, and reported to 'done_queue' as (link, None).
+    """
+    while (item := await in_queue.get()) is not None:
+        try:
+            result = await asyncio.wait_for(handler(*item), timeout)
+        except asyncio.TimeoutError:
+            logger.info("Dropping %s: %s took longer than %ss", item[0], handler.__name__, timeout)
+            result = None
+        except Exception as e:
+            logger.info("Dropping %s: %s failed: %s", item[0], handler.__name__, e)
+            result = None
+        if result is None:
+            await done_queue.put((item[0], None))
+        else:
+            await out_queue.put(result)
+
+async def batch_stage_worker(handler, in_queue, out_queue, done_queue, timeout=None,
+                             token_budget=0, max_item_tokens=0, max_items=1):
+    """
+    Pipeline worker like stage_worker, but for (link, ..., n_tokens) items of at most
+    'max_item_tokens' tokens: together with the first waiting item, it takes up to 'max_items'
+    items already queued while any further item is sure to fit into 'token_budget',
+    and passes the batch to 'handler' at once. The 'timeout' applies per item.
+    'handler' returns a result or None per item.
+    """
+    stopping = False
+    while not stopping:
+        item = await in_queue.get()
+        if item is None:
+            break
+
+        # An item is only taken when it fits, so nothing is held back from idle workers
+        batch = [item]
+        n_tokens = item[-1]
+        while len(batch) < max_items and n_tokens + max_item_tokens <= token_budget and not in_queue.empty():
+            next_item = in_queue.get_nowait()
+            if next_item is None:
+                stopping = True
+                break
+            batch.append(next_item)
+            n_tokens += next_item[-1]
+
+        batch_timeout = timeout * len(batch) if timeout else None
+        try:
+            results = await asyncio.wait_for(handler(batch), batch_timeout)
+        except asyncio.TimeoutError:
+            logger.info("Dropping %s links: %s took longer than %ss", len(batch), handler.__name__, batch_timeout)
+            results = [None] * len(batch)
+        except Exception as e:
+            logger.info("Dropping %s links: %s failed: %s", len(batch), handler.__name__, e)
+            results = [None] * len(batch)
+        for batch_item, result in zip(batch, results):
+            if result is None:
+                await done_queue.put((batch_item[0], None))
+            else:
+                await out_queue.put(result)
+
+async def process_links(run, links):
+    """
+    Process (link, search query) pairs in a fetch -> parse -> LLM pipeline.
+    Each stage has its own pool of workers connected by queues, so pages move on
+    to the next stage as soon as they are ready instead of waiting for the slowest link.
+    Worker counts and per-link timeouts come from the config of the RunState 'run'.
+    With 'cfg.batch_extract', the LLM stage
+    judges and extracts all pages waiting for it in one call, up to 'cfg.batch_extract_pages' pages
+    and 'cfg.batch_extract_tokens' page tokens per call.
+    Yields (link, context) for every link as soon as it leaves the pipeline;
+    the context is None if the link was dropped on the way.
+    """
+
+    logger.info("process_links")
+
+    cfg = run.cfg
+    user_query = cfg.user_query
+
+    async def fetch(link, query):
+        logger.info("Fetching content from: %s", link)
+        page = await fetch_webpage_text_async(run, link)
+        return (link, query, page) if page else None
 
-    if useful == "Yes":
-        context = await extract_relevant_context_async(session, user_query, search_query, page_text)
+    async def parse(link, query, page):
+        page_text = await page_to_text_async(link, page, cfg.min_text_chars)
+        if not page_text:
+            return None
+        page_text, n_tokens = await truncate_to_tokens_async(run.session, page_text, cfg.max_page_tokens)
+        return (link, query, page_text, n_tokens)
+
+    async def judge_and_extract(link, query, page_text, n_tokens):
+        context = await judge_and_extract_async(run, user_query, query, page_text)
         if context:
             logger.info("Extracted context from %s: %s", link, context)
-            return context
-    return None
+            return (link, context)
+        return None
+
+    async def judge_and_extract_batch(batch):
+        if len(batch) == 1:
+            return [await judge_and_extract(*batch[0])]
+
+        logger.info("Judging and extracting %s pages in one call", len(batch))
+        contexts = await judge_and_extract_batch_async(
+            run, user_query, [(query, page_text) for _, query, page_text, _ in batch]
+        )
+        results = []
+        for (link, _, _, _), context in zip(batch, contexts):
+            if context:
+                logger.info("Extracted context from %s: %s", link, context)
+            results.append((link, context) if context else None)
+        return results
+
+    def start_worker(handler, idx, timeout):
+        if handler is judge_and_extract_batch:
+            return batch_stage_worker(
+                handler, queues[idx], queues[idx + 1], queues[-1], timeout,
+                cfg.batch_extract_tokens, cfg.max_page_tokens, cfg.batch_extract_pages
+            )
+        return stage_worker(handler, queues[idx], queues[idx + 1], queues[-1], timeout)
 
-async def get_new_search_queries_async(session, user_query, previous_search_queries, all_contexts, n_queries = 4):
+    stages = [
+        (fetch, cfg.fetch_concurrency, cfg.link_fetch_timeout),
+        (parse, cfg.parse_concurrency, None),
+        (judge_and_extract_batch if cfg.batch_extract else judge_and_extract, cfg.llm_concurrency, cfg.link_llm_timeout)
+    ]
+    queues = [asyncio.Queue() for _ in range(len(stages) + 1)]
+    for link in links:
+        queues[0].put_nowait(link)
+
+    workers = [
+        [
+            asyncio.create_task(start_worker(handler, idx, timeout))
+            for _ in range(max(1, min(n_workers, len(links))))
+        ]
+        for idx, (handler, n_workers, timeout) in enumerate(stages)
+    ]
+
+    async def shutdown():
+        # Shut the stages down in order: a stage gets its sentinels once the previous one has drained.
+        # The consumer always gets its sentinel, even if a worker died, so it can't wait forever.
+        try:
+            for idx, stage_workers in enumerate(workers):
+                for _ in stage_workers:
+                    queues[idx].put_nowait(None)
+                for result in await asyncio.gather(*stage_workers, return_exceptions=True):
+                    if isinstance(result, Exception):
+                        logger.info("Pipeline worker failed: %s", result)
+        finally:
+            queues[-1].put_nowait(None)
+
+    shutdown_task = asyncio.create_task(shutdown())
+    try:
+        while (result := await queues[-1].get()) is not None:
+            yield result
+    finally:
+        if not shutdown_task.done():
+            for task in [shutdown_task] + [task for stage_workers in workers for task in stage_workers]:
+                task.cancel()
+        await asyncio.gather(shutdown_task, return_exceptions=True)
+
+async def get_new_search_queries_async(run, user_query, previous_search_queries, all_contexts, n_queries = 4):
     """
-    Determine if additional search queries are needed and return new queries or empty string.
+    Determine if additional search queries are needed.
+    Returns a plan {"done": <bool>, "queries": <list of new queries>}.
     """
 
     logger.info("get_new_search_queries_async")
 
     context_combined = "\n".join(all_contexts)
-    prompt = (
-        "You are an analytical research assistant. Based on the original query, the search queries performed so far, "
-        "and the extracted contexts from webpages, determine if further research is needed. "
-        f"If further research is needed, provide up to {n_queries} new search queries as a Python list. "
-        "If no further research is needed, respond with exactly ."
-    )
-    json_key = "queries"
 
     messages = [
-        {"role": "system", "content": "You are a systematic research planner."},
-        {"role": "user", "content": f"User Query: {user_query}\n"
-        "Previous Search Queries: {previous_search_queries}\n"
-        "\nExtracted Relevant Contexts:\n{context_combined}\n"
-        "\n{prompt}\n"
-        "Return a JSON object that contains a list of queries precisely in the following format: "
-        f'{{"{json_key}" : ["query1", "query2", "query3"]}}'}
+        {"role": "system", "content": SYS_PLAN},
+        {"role": "user", "content": f"{render_prompt(INSTRUCTION_PLAN, n_queries)}\n\n"
+        f"User Query: {user_query}\n"
+        f"Previous Search Queries: {previous_search_queries}\n"
+        f"\nExtracted Relevant Contexts:\n{context_combined}"}
     ]
 
-    response = await call_llamacpp_async(session, messages)
+    response = await call_llamacpp_async(run, messages, response_format=PLAN_FORMAT)
 
-    search_queries = []
+    plan = {"done": False, "queries": []}
     if response:
         try:
-            search_queries = extract_json(response).get(json_key, [])
-            logger.info(f"Parsed search query list: {search_queries}")
-            if not isinstance(search_queries, list):
+            result = extract_json(response)
+            plan["done"] = result.get("done") is True
+            plan["queries"] = result.get("queries", [])
+            logger.info(f"Parsed plan: {plan}")
+            if not isinstance(plan["queries"], list):
+                plan["queries"] = []
                 raise Exception(f"Could not parse a search query list the response.")
         except Exception as e:
             logger.info(f"Error parsing new search queries: {e}")
 
-    return search_queries
+    return plan
 
-async def generate_final_report_async(session, user_query, all_contexts):
+async def generate_final_report_async(run, user_query, all_contexts):
     """
     Generate the final comprehensive report using all gathered contexts.
     """
@@ -311,91 +1057,192 @@ async def generate_final_report_async(session, user_query, all_contexts):
     logger.info("generate_final_report_async")
 
     context_combined = "\n".join(all_contexts)
-    prompt = (
-        "You are an expert researcher and report writer. Based on the gathered contexts below and the original query, "
-        "write a comprehensive, well-structured, and detailed report that addresses the query thoroughly. "
-        "Include all relevant insights and conclusions without extraneous commentary."
-    )
     messages = [
-        {"role": "system", "content": "You are a skilled report writer."},
-        {"role": "user", "content": f"User Query: {user_query}\n\nGathered Relevant Contexts:\n{context_combined}\n\n{prompt}"}
+        {"role": "system", "content": SYS_REPORT},
+        {"role": "user", "content": f"{INSTRUCTION_REPORT}\n\nUser Query: {user_query}\n\nGathered Relevant Contexts:\n{context_combined}"}
     ]
-    report = await call_llamacpp_async(session, messages)
+    report = await call_llamacpp_async(run, messages)
     return report if report else "No report generated."
 
 # =========================
 # Main Asynchronous Routine
 # =========================
 
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    Settings of a research run; missing configuration file entries take the defaults below.
+    The tuning entries default to the module constants of the same upper-case name.
+    """
+    user_query: str
+    n_iterations: int = 2
+    n_queries: int = 2
+    max_links_per_query: int = 5
+    max_retries: int = 5
+    batch_extract: bool = True
+    temperature: float = LLM_TEMPERATURE
+    llm_cache: bool = True
+    llm_concurrency: int = LLM_CONCURRENCY
+    fetch_concurrency: int = FETCH_CONCURRENCY
+    parse_concurrency: int = PARSE_CONCURRENCY
+    link_fetch_timeout: float = LINK_FETCH_TIMEOUT
+    link_llm_timeout: float = LINK_LLM_TIMEOUT
+    max_page_tokens: int = MAX_PAGE_TOKENS
+    min_text_chars: int = MIN_TEXT_CHARS
+    context_token_budget: int = CONTEXT_TOKEN_BUDGET
+    batch_extract_tokens: int = BATCH_EXTRACT_TOKENS
+    batch_extract_pages: int = BATCH_EXTRACT_PAGES
+    planner_start_fraction: float = PLANNER_START_FRACTION
+    query_similarity_threshold: float = QUERY_SIMILARITY_THRESHOLD
+    context_similarity_threshold: float = CONTEXT_SIMILARITY_THRESHOLD
+    planner_query_history: int = PLANNER_QUERY_HISTORY
+
+    @classmethod
+    def from_dict(cls, entries):
+        unknown = entries.keys() - cls.__dataclass_fields__.keys()
+        if unknown:
+            logger.info("Ignoring unknown config entries: %s", sorted(unknown))
+        return cls(**{k: v for k, v in entries.items() if k in cls.__dataclass_fields__})
+
+@dataclass(slots=True)
+class RunState:
+    """
+    Per-run state passed to the helpers: the HTTP session, the config,
+    the LLM and fetch concurrency limits, and the optional LLM reply cache.
+    """
+    session: aiohttp.ClientSession
+    cfg: Config
+    llm_semaphore: asyncio.Semaphore
+    fetch_semaphore: asyncio.Semaphore
+    llm_cache: LLMCache | None = None
+
 async def async_main(config):
+    # The user query is given inline, as {"filename": <path>}, or typed in
     if "user_query" not in config:
-        config["user_query"] = input("Enter your research query/topic: ").strip()
+        user_query = await asyncio.to_thread(input, "Enter your research query/topic: ")
+        user_query = user_query.strip()
+    elif isinstance(config["user_query"], dict):
+        user_query = Path(config["user_query"]["filename"]).read_text(encoding="utf-8")
     else:
-        user_query_entry = config["user_query"]
-        if "filename" in user_query_entry:
-            with open(user_query_entry["filename"], "r", encoding="utf-8") as user_query_file:
-                config["user_query"] = user_query_file.read()
-        else:
-            config["user_query"] = user_query_entry
+        user_query = config["user_query"]
 
-    config["n_iterations"] = config["n_iterations"] if "n_iterations" in config else 2
-    config["n_queries"] = config["n_queries"] if "n_queries" in config else 2
-    config["max_links_per_query"] = config["max_links_per_query"] if "max_links_per_query" in config else 5
-    logger.info(config)
+    cfg = Config.from_dict({**config, "user_query": user_query})
+    logger.info(orjson.dumps(cfg).decode())
 
-    user_query = config["user_query"]
-    n_iterations = config["n_iterations"]
-    n_queries = config["n_queries"]
-    max_links = config["max_links_per_query"]
-    max_retries = config["max_retries"]
+    ddg_cache = ResponseCache(DDG_CACHE_PATH) if DDG_CACHE_ENABLED else None
+    if cfg.llm_cache and cfg.temperature != 0:
+        logger.info("LLM cache disabled: temperature %s is not deterministic", cfg.temperature)
 
+    # (relevance to the user query, token count, context) entries
     aggregated_contexts = []
+    user_query_vector = term_vector(user_query)
     all_search_queries = []
+    seen_queries = set()
+    query_vectors = []
+    context_vectors = []
+    processed_links = set()
     iteration = 0
 
-    async with aiohttp.ClientSession() as session:
-        new_search_queries = await generate_search_queries_async(session, user_query, n_queries)
+    # Idle connections are kept for 75s, matching the nginx keep-alive default
+    connector = aiohttp.TCPConnector(
+        limit=200,
+        limit_per_host=32,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True
+    )
+    async with aiohttp.ClientSession(connector=connector, timeout=SESSION_TIMEOUT, headers=SESSION_HEADERS) as session:
+        # Replies are cached per served model, so swapping the GGUF file behind the server never replays stale replies
+        model = await get_model_id_async(session) if cfg.llm_cache and cfg.temperature == 0 else ""
+        if cfg.llm_cache and cfg.temperature == 0 and not model:
+            logger.info("LLM cache disabled: the served model is unknown")
+        run = RunState(
+            session, cfg,
+            asyncio.Semaphore(cfg.llm_concurrency),
+            asyncio.Semaphore(cfg.fetch_concurrency),
+            LLMCache(LLM_CACHE_PATH, LLM_CACHE_TTL, model) if model else None
+        )
+
+        new_search_queries = await generate_search_queries_async(run, user_query, cfg.n_queries)
+        new_search_queries = drop_seen_queries(new_search_queries, seen_queries)
+        new_search_queries = drop_similar_texts(new_search_queries, query_vectors, cfg.query_similarity_threshold)
         if not new_search_queries:
             logger.info("No initial search queries generated. Exiting.")
             return
         all_search_queries.extend(new_search_queries)
 
-        while iteration < n_iterations:
+        while iteration < cfg.n_iterations:
             logger.info(f"\n=== Iteration {iteration + 1} ===")
 
-            # Perform searches for all current queries
-            #search_tasks = [perform_search_async(query) for query in new_search_queries]
-            #search_results = await asyncio.gather(*search_tasks)
-            search_results = [perform_ddg_search(query, max_links, max_retries) for query in new_search_queries]
+            # Perform searches for all current queries concurrently, off the event loop
+            search_tasks = [
+                asyncio.to_thread(perform_ddg_search, query, cfg.max_links_per_query, cfg.max_retries, ddg_cache)
+                for query in new_search_queries
+            ]
+            search_results = await asyncio.gather(*search_tasks, return_exceptions=True)
+            for idx, links in enumerate(search_results):
+                if isinstance(links, Exception):
+                    logger.info("Search for '%s' failed: %s", new_search_queries[idx], links)
+                    search_results[idx] = []
 
-            # Map links to their original search queries
+            # Map canonical links to the original link and its search query,
+            # skipping links processed in earlier iterations and unsupported links
             unique_links = {}
             for idx, links in enumerate(search_results):
                 query = new_search_queries[idx]
                 for link in links:
-                    if link not in unique_links:
-                        unique_links[link] = query
+                    canonical_link = canonicalize_url(link)
+                    if canonical_link in unique_links or canonical_link in processed_links:
+                        continue
+                    if not is_link_supported(canonical_link):
+                        logger.info("Skipping unsupported link: %s", link)
+                        continue
+                    unique_links[canonical_link] = (link, query)
 
             logger.info(f"Found {len(unique_links)} unique links for processing")
 
-            # Process all links concurrently
-            link_tasks = [process_link(session, link, user_query, unique_links[link]) for link in unique_links]
-            link_results = await asyncio.gather(*link_tasks)
-
-            # Aggregate valid contexts
-            iteration_contexts = [res for res in link_results if res]
-            aggregated_contexts.extend(iteration_contexts)
-            logger.info(f"Added {len(iteration_contexts)} new contexts")
+            # Process all links concurrently, aggregating valid contexts as soon as they arrive.
+            # Planning the next iteration starts on the contexts gathered so far once most
+            # of the links are done, so it overlaps with the slowest links.
+            n_contexts = len(aggregated_contexts)
+            n_finished = 0
+            planner_task = None
+            links = list(unique_links.values())
+            async for _, context in process_links(run, links):
+                n_finished += 1
+                if context and drop_similar_texts([context], context_vectors, cfg.context_similarity_threshold):
+                    relevance = cosine_similarity(term_vector(context), user_query_vector)
+                    n_tokens = await count_tokens_async(session, context)
+                    aggregated_contexts.append((relevance, n_tokens, context))
+                if not planner_task and n_finished < len(unique_links) \
+                        and n_finished >= cfg.planner_start_fraction * len(unique_links):
+                    logger.info("Starting the planner after %s of %s links", n_finished, len(unique_links))
+                    trim_contexts(aggregated_contexts, cfg.context_token_budget)
+                    planner_task = asyncio.create_task(get_new_search_queries_async(
+                        run, user_query, all_search_queries[-cfg.planner_query_history:],
+                        [c for _, _, c in aggregated_contexts], cfg.n_queries
+                    ))
+            processed_links.update(unique_links)
+            logger.info(f"Added {len(aggregated_contexts) - n_contexts} new contexts")
+            trim_contexts(aggregated_contexts, cfg.context_token_budget)
 
             # Check if more research is needed
-            new_search_queries = await get_new_search_queries_async(
-                session, user_query, all_search_queries, aggregated_contexts
-            )
-
-            if new_search_queries == "":
+            if not planner_task:
+                planner_task = asyncio.create_task(get_new_search_queries_async(
+                    run, user_query, all_search_queries[-cfg.planner_query_history:],
+                    [c for _, _, c in aggregated_contexts], cfg.n_queries
+                ))
+            plan = await planner_task
+
+            if plan["done"]:
                 logger.info("Research complete according to LLM assessment")
                 break
-            elif new_search_queries:
+            new_search_queries = plan["queries"]
+
+            # Repeats and paraphrases of earlier queries would only find the same pages again
+            new_search_queries = drop_seen_queries(new_search_queries, seen_queries)
+            new_search_queries = drop_similar_texts(new_search_queries, query_vectors, cfg.query_similarity_threshold)
+            if new_search_queries:
                 logger.info(f"Generated {len(new_search_queries)} new search queries")
                 all_search_queries.extend(new_search_queries)
             else:
@@ -404,16 +1251,32 @@ async def async_main(config):
 
             iteration += 1
 
+        # When the iteration limit cut the research short, search for the queries planned last
+        # while the report is generated, so a follow-up run finds them in the DuckDuckGo cache.
+        # These searches are tried only once: backing off would keep the process alive after the report.
+        prefetch_task = None
+        if ddg_cache and iteration >= cfg.n_iterations and new_search_queries:
+            logger.info("Prefetching searches for %s unused queries", len(new_search_queries))
+            prefetch_task = asyncio.gather(*[
+                asyncio.to_thread(perform_ddg_search, query, cfg.max_links_per_query, 1, ddg_cache)
+                for query in new_search_queries
+            ], return_exceptions=True)
+
         # Generate final report
         logger.info("\nGenerating final report...")
-        final_report = await generate_final_report_async(session, user_query, aggregated_contexts)
+        final_report = await generate_final_report_async(run, user_query, [c for _, _, c in aggregated_contexts])
         logger.info("\n==== FINAL REPORT ====\n")
         logger.info(final_report)
 
+        # Searches run in worker threads and can't be cancelled, so let them finish
+        if prefetch_task:
+            await prefetch_task
+
+    if run.llm_cache:
+        logger.info("LLM cache stats: %s", run.llm_cache.stats)
+
 def read_config_file(config_filename: str):
-    with open(config_filename) as f:
-        config = json.load(f)
-    return config
+    return orjson.loads(Path(config_filename).read_bytes())
 
 def main():
     def valid_file(filename):
@@ -433,7 +1296,14 @@ def main():
     args = parser.parse_args()
     config = read_config_file(args.config_file)
 
-    asyncio.run(async_main(config))
+    if uvloop and hasattr(asyncio, "Runner"):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            runner.run(async_main(config))
+    else:
+        # Python 3.10 has no asyncio.Runner, uvloop is installed as the loop policy instead
+        if uvloop:
+            uvloop.install()
+        asyncio.run(async_main(config))
 
 if __name__ == "__main__":
     main()